@@ -1,31 +1,51 @@
 import streamlit as st
 import sqlite3
 import pandas as pd
+import numpy as np
 import os
+from contextlib import contextmanager
 
 # ==========================================
 # 0. 系统配置 (Configuration)
 # ==========================================
 DB_FILE = "tuan_eval.db"
 EXCEL_FILE = "members.xlsx"
+# 数据库结构版本 (记录在 PRAGMA user_version 中，结构变化时递增)
+SCHEMA_VERSION = 1
 
-# 定义4位班干部的学号 (系统会自动识别这些账号拥有“组织评议”权限)
-OFFICER_IDS = [
+# 定义4位班干部的学号 (系统启动时会同步到数据库，这些账号拥有“组织评议”权限)
+OFFICER_IDS = frozenset({
     "251812037", # 余维乐
     "251812057", # 刘荣旭
     "251812069", # 周文丽
     "251812070"  # 黄媛媛
-]
+})
 
 # ==========================================
 # 1. 数据库配置与初始化 (Model Layer)
 # ==========================================
 
+def sync_officer_roles(c):
+    """按 OFFICER_IDS 双向同步班干部角色 (列表增删后升级或撤销 officer)"""
+    officer_marks = ','.join('?' * len(OFFICER_IDS))
+    c.execute(f"UPDATE users SET role='officer' WHERE role='student' AND uid IN ({officer_marks})",
+              tuple(OFFICER_IDS))
+    c.execute(f"UPDATE users SET role='student' WHERE role='officer' AND uid NOT IN ({officer_marks})",
+              tuple(OFFICER_IDS))
+
+@st.cache_resource
 def init_db():
-    """初始化数据库表结构，并从Excel导入真实用户数据"""
+    """初始化数据库表结构，并从Excel导入真实用户数据 (每个进程只执行一次)"""
     conn = sqlite3.connect(DB_FILE)
     c = conn.cursor()
     
+    # 已是当前版本的数据库无需再检查表结构，只同步班干部名单
+    if c.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+        sync_officer_roles(c)
+        conn.commit()
+        conn.close()
+        return
+    
     # 用户表
     c.execute('''CREATE TABLE IF NOT EXISTS users (
                     uid TEXT PRIMARY KEY,
@@ -50,11 +70,19 @@ def init_db():
                     candidate_uid TEXT,
                     PRIMARY KEY (voter_uid, candidate_uid))''')
     
+    # 索引：主键以 voter_uid 开头，按候选人统计票数需要单独的索引
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pv_cand ON peer_votes(candidate_uid)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ov_cand ON officer_votes(candidate_uid)")
+    
     # --- 数据初始化逻辑 ---
     c.execute("SELECT count(*) FROM users")
     if c.fetchone()[0] == 0:
         print("检测到首次运行，正在初始化数据...")
         
+        # 导入期间关闭落盘同步，整个初始化只在最后提交一次
+        c.execute("PRAGMA journal_mode=MEMORY")
+        c.execute("PRAGMA synchronous=OFF")
+        
         # 创建管理员
         c.execute("INSERT INTO users VALUES ('admin', '管理员', 'admin', '123456')")
         
@@ -62,93 +90,151 @@ def init_db():
         if os.path.exists(EXCEL_FILE):
             try:
                 # 强制将学号读取为字符串，防止丢失前导0或变成科学计数法
-                df = pd.read_excel(EXCEL_FILE, dtype={'学号': str, '姓名': str})
-                count = 0
-                for index, row in df.iterrows():
-                    name = str(row['姓名']).strip()
-                    uid = str(row['学号']).strip()
-                    # 默认密码为学号后6位
-                    password = uid[-6:] if len(uid) >= 6 else uid
-                    
-                    c.execute("INSERT INTO users VALUES (?, ?, 'student', ?)", (uid, name, password))
-                    count += 1
+                # 使用 calamine (Rust 实现) 解析 xlsx，比 openpyxl 快得多
+                df = pd.read_excel(EXCEL_FILE, dtype={'学号': str, '姓名': str}, engine='calamine')
+                uids = df['学号'].astype(str).str.strip()
+                names = df['姓名'].astype(str).str.strip()
+                # 班干部在导入时即标记为 officer 角色
+                roles = np.where(uids.isin(OFFICER_IDS), 'officer', 'student')
+                # 默认密码为学号后6位 (不足6位则为完整学号)
+                passwords = uids.str[-6:]
+                
+                rows = list(zip(uids, names, roles, passwords))
+                c.executemany("INSERT INTO users VALUES (?, ?, ?, ?)", rows)
                 
-                print(f"✅ 成功导入 {count} 位同学数据！")
+                print(f"✅ 成功导入 {len(rows)} 位同学数据！")
                 
             except Exception as e:
                 print(f"❌ 读取 {EXCEL_FILE} 失败: {e}")
         else:
             print(f"⚠️ 未找到 {EXCEL_FILE} 文件！")
 
-        conn.commit()
+    sync_officer_roles(c)
+    c.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    conn.commit()
     
     conn.close()
 
+@st.cache_resource
 def get_db_connection():
-    return sqlite3.connect(DB_FILE)
+    """
+    进程内共享一个只读连接，避免每次 rerun 重新打开 SQLite 文件
+    所有会话线程同时使用这个连接，写操作请使用 open_write_connection()
+    """
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    # WAL 模式下读写互不阻塞，多人同时投票时读取不会被写入卡住
+    for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY", "cache_size=-20000"):
+        conn.execute(f"PRAGMA {pragma}")
+    return conn
+
+@contextmanager
+def open_write_connection():
+    """
+    为一次写操作打开独立的短连接，用完即关
+    每个写事务各自持有连接，并发提交时由 SQLite 加锁排队，互不干扰
+    """
+    conn = sqlite3.connect(DB_FILE, timeout=10, isolation_level="IMMEDIATE")
+    try:
+        yield conn
+    finally:
+        conn.close()
 
 # ==========================================
 # 2. 核心算法逻辑 (Controller Layer)
 # ==========================================
 
-def calculate_results():
+@st.cache_data(ttl=300, show_spinner=False)
+def get_candidates(exclude_uid=None):
+    """返回候选人 {学号: "姓名 (学号)"} 字典，exclude_uid 用于排除投票人自己"""
+    conn = get_db_connection()
+    if exclude_uid is None:
+        df = pd.read_sql("SELECT uid, name FROM users WHERE role!='admin'", conn)
+    else:
+        df = pd.read_sql("SELECT uid, name FROM users WHERE role!='admin' AND uid != ?", conn, params=(exclude_uid,))
+    labels = df['name'] + ' (' + df['uid'] + ')'
+    return dict(zip(df['uid'].to_numpy(), labels.to_numpy()))
+
+def get_vote_stamp():
+    """返回各投票表的记录数，作为结果缓存的失效标记"""
+    conn = get_db_connection()
+    return conn.execute(
+        "SELECT (SELECT COUNT(*) FROM self_evals), "
+        "(SELECT COUNT(*) FROM peer_votes), "
+        "(SELECT COUNT(*) FROM officer_votes)"
+    ).fetchone()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def calculate_results(vote_stamp):
     """
     计算最终得分与排名
+    vote_stamp: get_vote_stamp() 的返回值，投票数据变化时使缓存失效
     """
     conn = get_db_connection()
     
-    # 获取所有学生 (包括班干部)
-    students = pd.read_sql("SELECT uid, name FROM users WHERE role='student' OR role='officer'", conn)
-    
-    # 1. 获取自评分
-    self_df = pd.read_sql("SELECT uid, score as self_score FROM self_evals", conn)
-    
-    # 2. 统计团员互评 (票数)
-    votes_df = pd.read_sql("SELECT candidate_uid as uid, COUNT(*) as vote_count FROM peer_votes GROUP BY candidate_uid", conn)
-    
-    # 3. 统计组织评议 (班干票数)
-    officer_votes_df = pd.read_sql("SELECT candidate_uid as uid, COUNT(*) as officer_vote_count FROM officer_votes GROUP BY candidate_uid", conn)
-    
-    # 合并数据
-    df = students.merge(self_df, on='uid', how='left').fillna(0)
-    df = df.merge(votes_df, on='uid', how='left').fillna(0)
-    df = df.merge(officer_votes_df, on='uid', how='left').fillna(0)
+    # 一次查询取回所有学生 (包括班干部) 的自评分、互评票数与班干票数
+    df = pd.read_sql("""
+        SELECT u.uid, u.name,
+               COALESCE(s.score, 0) AS self_score,
+               COALESCE(p.c, 0) AS vote_count,
+               COALESCE(o.c, 0) AS officer_vote_count
+        FROM users u
+        LEFT JOIN self_evals s USING (uid)
+        LEFT JOIN (SELECT candidate_uid AS uid, COUNT(*) AS c
+                   FROM peer_votes GROUP BY candidate_uid) p USING (uid)
+        LEFT JOIN (SELECT candidate_uid AS uid, COUNT(*) AS c
+                   FROM officer_votes GROUP BY candidate_uid) o USING (uid)
+        WHERE u.role!='admin'
+    """, conn)
     
     # --- 分数计算逻辑 ---
     
     # A. 团员互评折算分 (30%)
     # 公式：(得票数 / (总人数-1)) * 100
-    total_students = len(students)
+    total_students = len(df)
     max_peer_votes = total_students - 1 if total_students > 1 else 1
-    df['peer_score'] = (df['vote_count'] / max_peer_votes) * 100
+    peer_score = df['vote_count'].to_numpy(dtype=np.float64) / max_peer_votes * 100
+    df['peer_score'] = peer_score
     
     # B. 组织评议折算分 (40%)
     # 公式：(获得班干票数 / 4) * 100
-    df['org_score'] = (df['officer_vote_count'] / 4) * 100
+    org_score = df['officer_vote_count'].to_numpy(dtype=np.float64) / 4 * 100
+    df['org_score'] = org_score
     
     # C. 综合得分
     # 综合评议得分 = 自评×30% + 团员互评×30% + 组织评议×40%
-    df['final_score'] = (df['self_score'] * 0.3) + (df['peer_score'] * 0.3) + (df['org_score'] * 0.4)
+    # 按公式顺序逐项相乘再相加 (矩阵乘法的求和顺序不同，舍入到两位小数后会改变部分得分)
+    self_score = df['self_score'].to_numpy(dtype=np.float64)
+    df['final_score'] = self_score * 0.3 + peer_score * 0.3 + org_score * 0.4
     
-    # 格式化保留两位小数
-    df['final_score'] = df['final_score'].round(2)
-    df['peer_score'] = df['peer_score'].round(2)
-    df['org_score'] = df['org_score'].round(2)
+    # 格式化保留两位小数 (三列一次性处理)
+    score_cols = ['peer_score', 'org_score', 'final_score']
+    df[score_cols] = df[score_cols].round(2)
     
     # 排名 (同分处理：组织分 > 互评票 > 自评)
-    df = df.sort_values(by=['final_score', 'org_score', 'vote_count', 'self_score'], ascending=[False, False, False, False])
+    # 四个排序字段按位拼成一个 int64 复合键，一次 argsort 完成降序排序
+    # (各分数在 0-100 之间、精确到两位小数，票数远小于 10000)
+    final_key = np.rint(df['final_score'].to_numpy() * 100).astype(np.int64)
+    org_key = np.rint(df['org_score'].to_numpy() * 100).astype(np.int64)
+    vote_key = df['vote_count'].to_numpy().astype(np.int64)
+    self_key = np.rint(df['self_score'].to_numpy() * 100).astype(np.int64)
+    sort_key = ((final_key * 10001 + org_key) * 10000 + vote_key) * 10001 + self_key
+    df = df.iloc[np.argsort(-sort_key, kind='stable')].reset_index(drop=True)
     
     # 评定结果
-    df['rank'] = range(1, len(df) + 1)
-    df['result'] = df['rank'].apply(lambda x: "优秀团员" if x <= 10 else "合格团员")
+    df['rank'] = np.arange(1, len(df) + 1, dtype=np.int32)
+    df['result'] = np.where(df['rank'].to_numpy() <= 10, "优秀团员", "合格团员")
     
-    conn.close()
     return df
 
 # ==========================================
 # 3. 前端界面 (View Layer)
 # ==========================================
 
+@st.cache_data(show_spinner=False)
+def df_to_csv_bytes(df):
+    """将结果表导出为 CSV 字节串 (带 BOM，Excel 可直接打开中文)"""
+    return df.to_csv(index=False).encode('utf-8-sig')
+
 def main():
     st.set_page_config(page_title="团员评议系统", layout="wide")
     
@@ -185,17 +271,14 @@ def main():
                     cur = conn.cursor()
                     cur.execute("SELECT uid, name, role FROM users WHERE uid=? AND password=?", (uid, pwd))
                     user = cur.fetchone()
-                    conn.close()
                     
                     if user:
                         # 构造用户数据字典
                         user_data = {'uid': user[0], 'name': user[1], 'role': user[2]}
-                        
-                        # 如果学号在班干列表里，强制提升为 officer 角色
-                        if user_data['uid'] in OFFICER_IDS:
-                            user_data['role'] = 'officer'
-                            
                         st.session_state['user'] = user_data
+                        # 候选人列表按登录用户缓存，换账号时需重新生成
+                        for key in ('peer_opts', 'officer_opts'):
+                            st.session_state.pop(key, None)
                         st.rerun()
                     else:
                         st.error("账号或密码错误。")
@@ -218,6 +301,8 @@ def main():
         st.markdown("---")
         if st.button("🚪 退出登录", type="primary"):
             del st.session_state['user']
+            for key in ('peer_opts', 'officer_opts'):
+                st.session_state.pop(key, None)
             st.rerun()
 
     # ==========================
@@ -249,21 +334,23 @@ def main():
                 with st.form("self_form"):
                     score = st.number_input("分数", 0, 100, step=1)
                     if st.form_submit_button("提交"):
-                        cur.execute("INSERT INTO self_evals VALUES (?, ?)", (user['uid'], score))
-                        conn.commit()
+                        with open_write_connection() as wconn:
+                            with wconn:
+                                wconn.execute("INSERT INTO self_evals VALUES (?, ?)", (user['uid'], score))
                         st.rerun()
 
         # --- Tab 2: 团员互评 (30%) ---
         # 规则：不可选自己，限制最多选10人
         with tabs[1]:
-            cur.execute("SELECT count(*) FROM peer_votes WHERE voter_uid=?", (user['uid'],))
-            if cur.fetchone()[0] > 0:
+            cur.execute("SELECT 1 FROM peer_votes WHERE voter_uid=? LIMIT 1", (user['uid'],))
+            if cur.fetchone() is not None:
                 st.success("✅ 团员互评已完成。")
             else:
                 st.info("请选择 **10位** 优秀团员 (❌不可选自己)")
                 # 排除自己
-                candidates = pd.read_sql("SELECT uid, name FROM users WHERE role!='admin' AND uid != ?", conn, params=(user['uid'],))
-                options = {row['uid']: f"{row['name']} ({row['uid']})" for i, row in candidates.iterrows()}
+                if 'peer_opts' not in st.session_state:
+                    st.session_state['peer_opts'] = get_candidates(user['uid'])
+                options = st.session_state['peer_opts']
                 
                 # 增加 max_selections=10 限制
                 selected = st.multiselect(
@@ -280,8 +367,10 @@ def main():
                         st.error("规则限制：必须 **凑满 10 人** 才能提交！")
                     else:
                         data = [(user['uid'], tid) for tid in selected]
-                        cur.executemany("INSERT INTO peer_votes VALUES (?, ?)", data)
-                        conn.commit()
+                        # 10 条记录在独立连接的同一个写事务 (BEGIN IMMEDIATE) 中提交，出错时整体回滚
+                        with open_write_connection() as wconn:
+                            with wconn:
+                                wconn.executemany("INSERT INTO peer_votes VALUES (?, ?)", data)
                         st.balloons()
                         st.rerun()
 
@@ -291,16 +380,17 @@ def main():
             with tabs[2]:
                 st.markdown("### ⚖️ 班干部特别通道")
                 
-                cur.execute("SELECT count(*) FROM officer_votes WHERE voter_uid=?", (user['uid'],))
-                if cur.fetchone()[0] > 0:
+                cur.execute("SELECT 1 FROM officer_votes WHERE voter_uid=? LIMIT 1", (user['uid'],))
+                if cur.fetchone() is not None:
                     st.success("✅ 您已完成组织评议投票。")
                 else:
                     st.warning("作为班干部，请推选 **10位** 优秀团员 (✅包含可以选自己)")
                     st.markdown("您的投票将直接决定同学们的 **组织评议分 (占40%)**。")
                     
                     # 可选所有人(包括自己)
-                    candidates_all = pd.read_sql("SELECT uid, name FROM users WHERE role!='admin'", conn)
-                    options_off = {row['uid']: f"{row['name']} ({row['uid']})" for i, row in candidates_all.iterrows()}
+                    if 'officer_opts' not in st.session_state:
+                        st.session_state['officer_opts'] = get_candidates(None)
+                    options_off = st.session_state['officer_opts']
                     
                     # 增加 max_selections=10 限制
                     selected_off = st.multiselect(
@@ -317,13 +407,13 @@ def main():
                             st.error("规则限制：必须 **凑满 10 人** 才能提交！")
                         else:
                             data = [(user['uid'], tid) for tid in selected_off]
-                            cur.executemany("INSERT INTO officer_votes VALUES (?, ?)", data)
-                            conn.commit()
+                            # 10 条记录在独立连接的同一个写事务 (BEGIN IMMEDIATE) 中提交，出错时整体回滚
+                            with open_write_connection() as wconn:
+                                with wconn:
+                                    wconn.executemany("INSERT INTO officer_votes VALUES (?, ?)", data)
                             st.balloons()
                             st.success("组织评议提交成功！")
                             st.rerun()
-                            
-        conn.close()
 
     # 2. 管理员界面
     elif user['role'] == 'admin':
@@ -331,11 +421,12 @@ def main():
         
         # 实时统计数据
         conn = get_db_connection()
-        student_count = pd.read_sql("SELECT count(*) FROM users WHERE role!='admin'", conn).iloc[0,0]
-        self_done = pd.read_sql("SELECT count(*) FROM self_evals", conn).iloc[0,0]
-        peer_done = pd.read_sql("SELECT count(DISTINCT voter_uid) FROM peer_votes", conn).iloc[0,0]
-        off_done = pd.read_sql("SELECT count(DISTINCT voter_uid) FROM officer_votes", conn).iloc[0,0]
-        conn.close()
+        student_count, self_done, peer_done, off_done = conn.execute(
+            "SELECT (SELECT count(*) FROM users WHERE role!='admin'), "
+            "(SELECT count(*) FROM self_evals), "
+            "(SELECT count(DISTINCT voter_uid) FROM peer_votes), "
+            "(SELECT count(DISTINCT voter_uid) FROM officer_votes)"
+        ).fetchone()
 
         c1, c2, c3, c4 = st.columns(4)
         c1.metric("总团员数", student_count)
@@ -346,7 +437,7 @@ def main():
         st.markdown("---")
         
         if st.button("🔄 刷新 / 计算最终结果"):
-            df = calculate_results()
+            df = calculate_results(get_vote_stamp())
             
             st.subheader("🏆 最终排名 (Top 10)")
             st.table(df[df['rank']<=10][['rank', 'name', 'final_score', 'result']])
@@ -354,16 +445,22 @@ def main():
             st.subheader("📑 详细数据表")
             st.dataframe(df)
             
-            st.download_button("📥 下载完整结果 CSV", df.to_csv().encode('utf-8-sig'), "result.csv")
+            st.download_button("📥 下载完整结果 CSV", df_to_csv_bytes(df), "result.csv")
         
         with st.expander("⚠️ 危险操作区"):
             st.warning("如果测试完毕需要正式使用，请点击下方按钮清空数据库。")
             if st.button("🗑️ 清空所有投票数据"):
-                conn = get_db_connection()
-                conn.execute("DELETE FROM self_evals")
-                conn.execute("DELETE FROM peer_votes")
-                conn.execute("DELETE FROM officer_votes")
-                conn.commit()
+                # 三张表在独立连接的同一事务中清空，随后回收空闲页
+                with open_write_connection() as wconn:
+                    with wconn:
+                        wconn.execute("DELETE FROM self_evals")
+                        wconn.execute("DELETE FROM peer_votes")
+                        wconn.execute("DELETE FROM officer_votes")
+                    try:
+                        wconn.execute("VACUUM")
+                    except sqlite3.OperationalError:
+                        # 数据已清空提交，回收空间失败 (如数据库繁忙) 不影响结果
+                        pass
                 st.success("数据已清空，可以开始正式投票。")
                 st.rerun()
 